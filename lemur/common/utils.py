@@ -6,6 +6,7 @@
 
 .. moduleauthor:: Kevin Glisson <kglisson@netflix.com>
 """
+import functools
 import random
 import re
 import string
@@ -19,6 +20,7 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, ec, padding
 from cryptography.hazmat.primitives.serialization import load_pem_private_key, Encoding, pkcs7
+from flask import current_app
 from flask_restful.reqparse import RequestParser
 from sqlalchemy import and_, func
 
@@ -381,3 +383,57 @@ def convert_pkcs7_bytes_to_pem(certs_pkcs7):
         certificates_pem.append(pem.parse(cert.public_bytes(encoding=Encoding.PEM))[0])
 
     return certificates_pem
+
+
+def run_in_app_context(func):
+    """
+    Wraps func so that it runs inside the Flask app context of the caller, even when it is called from another
+    thread, e.g. a worker of a thread pool. Config, logging and metrics then keep working in that thread.
+
+    :param func:
+    :return: the wrapped function
+    """
+    app = current_app._get_current_object()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def build_domain_trie(entries):
+    """
+    Builds a trie of domain names, keyed on their labels in reverse order: example.com is stored under
+    "com" -> "example". The values given for a domain are listed under the None key of its node.
+
+    :param entries: iterable of (domain, value) pairs
+    :return: the trie, to be searched with find_longest_domain_suffix
+    """
+    trie = {}
+    for domain, value in entries:
+        node = trie
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(value)
+    return trie
+
+
+def find_longest_domain_suffix(trie, domain):
+    """
+    Finds the most specific domain in the trie that is equal to the given domain or one of its parents, in one
+    walk along the labels of the domain.
+
+    :param trie: built by build_domain_trie
+    :param domain:
+    :return: the values of the matching domain, or an empty list if none matches
+    """
+    values = []
+    node = trie
+    for label in reversed(domain.split(".")):
+        node = node.get(label)
+        if node is None:
+            break
+        values = node.get(None, values)
+    return values
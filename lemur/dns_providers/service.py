@@ -1,4 +1,6 @@
 import json
+import time
+from collections import namedtuple
 
 from flask import current_app
 
@@ -31,6 +33,49 @@ def get_all_dns_providers():
     return DnsProvider.query.all()
 
 
+DNS_PROVIDERS_CACHE_TTL = 60
+_dns_providers_cache = {}
+
+# Plain copy of the DnsProvider columns used to issue certificates, safe to share between sessions and threads
+CachedDnsProvider = namedtuple(
+    "CachedDnsProvider", ["id", "name", "provider_type", "credentials", "options", "domains"]
+)
+
+
+def get_all_dns_providers_cached():
+    """
+    Retrieves all dns providers within Lemur, reusing the result of an earlier call for up to
+    DNS_PROVIDERS_CACHE_TTL seconds. Returns CachedDnsProvider values instead of DnsProvider instances,
+    since those are bound to the session they were loaded in.
+
+    :return:
+    """
+    cached = _dns_providers_cache.get("all")
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    dns_providers = [
+        CachedDnsProvider(
+            dns_provider.id,
+            dns_provider.name,
+            dns_provider.provider_type,
+            dns_provider.credentials,
+            dns_provider.options,
+            dns_provider.domains,
+        )
+        for dns_provider in get_all_dns_providers()
+    ]
+    _dns_providers_cache["all"] = (dns_providers, time.monotonic() + DNS_PROVIDERS_CACHE_TTL)
+    return dns_providers
+
+
+def invalidate_dns_providers_cache():
+    """
+    Drops the providers cached by get_all_dns_providers_cached, so the next call reads them from the database.
+    """
+    _dns_providers_cache.clear()
+
+
 def get_friendly(dns_provider_id):
     """
     Retrieves a dns provider by its lemur assigned ID.
@@ -62,6 +107,7 @@ def delete(dns_provider_id):
     :param dns_provider_id: Lemur assigned ID
     """
     database.delete(get(dns_provider_id))
+    invalidate_dns_providers_cache()
 
 
 def get_types():
@@ -115,6 +161,7 @@ def set_domains(dns_provider, domains):
     """
     dns_provider.domains = domains
     database.update(dns_provider)
+    invalidate_dns_providers_cache()
     return dns_provider
 
 
@@ -131,4 +178,5 @@ def create(data):
         credentials=json.dumps(credentials),
     )
     created = database.create(dns_provider)
+    invalidate_dns_providers_cache()
     return created.id
@@ -14,7 +14,10 @@
 """
 import datetime
 import json
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import OpenSSL.crypto
 import josepy as jose
@@ -25,7 +28,7 @@ from acme.errors import TimeoutError
 from acme.messages import Error as AcmeError
 from flask import current_app
 
-from lemur.common.utils import generate_private_key
+from lemur.common.utils import generate_private_key, build_domain_trie, find_longest_domain_suffix, run_in_app_context
 from lemur.dns_providers import service as dns_provider_service
 from lemur.exceptions import InvalidAuthority, UnknownProvider, InvalidConfiguration
 from lemur.extensions import metrics, sentry
@@ -35,6 +38,109 @@ from lemur.authorities import service as authorities_service
 from retrying import retry
 
 
+DNS_PROVIDER_TYPES = {
+    "cloudflare": cloudflare,
+    "dyn": dyn,
+    "route53": route53,
+    "ultradns": ultradns,
+    "powerdns": powerdns
+}
+
+PEM_CERTIFICATE_END = "-----END CERTIFICATE-----"
+
+ACME_CLIENT_CACHE_MAX_SIZE = 64
+ACME_CLIENT_CACHE_TTL = 3600
+
+# (authority id, directory url, account key, account registration) -> (ACME client, monotonic expiry time)
+_acme_client_cache = {}
+_acme_client_cache_lock = threading.Lock()
+
+CNAME_CACHE_MAX_SIZE = 4096
+CNAME_CACHE_MAX_TTL = 3600
+CNAME_NEGATIVE_CACHE_TTL = 300
+
+# lowercased domain -> (CNAME target or False, monotonic expiry time)
+_cname_cache = {}
+_cname_cache_lock = threading.Lock()
+
+DNS_CHALLENGE_MAX_WORKERS = 32
+
+# Thread pool shared by all DNS challenge steps, created on first use
+_dns_challenge_executor = None
+
+
+@lru_cache(maxsize=256)
+def _load_json(value):
+    """
+    Parses DNS provider credentials and authority options. The same few JSON strings are parsed for every domain,
+    challenge and provider of an order, so the parsed result is memoized and shared: callers must not modify it.
+    """
+    return json.loads(value)
+
+
+@lru_cache(maxsize=64)
+def _load_options(options):
+    """
+    Maps the names of the JSON encoded authority options to their values. Shared between callers like _load_json:
+    callers must not modify the result.
+    """
+    return {option["name"]: option.get("value") for option in _load_json(options)}
+
+
+@lru_cache(maxsize=8)
+def _parse_identrust_expiration_date(expiration_date):
+    """Parses IDENTRUST_CROSS_SIGNED_LE_ICA_EXPIRATION_DATE once, rather than on every issued certificate"""
+    return datetime.datetime.strptime(expiration_date, '%d/%m/%y')
+
+
+def _get_dns_challenge_executor():
+    """
+    Returns the thread pool shared by all DNS challenge steps. Its threads live as long as the process, so DNS
+    provider clients kept per thread, like the Dyn session, are reused instead of leaking one per short-lived pool.
+    """
+    global _dns_challenge_executor
+    if _dns_challenge_executor is None:
+        _dns_challenge_executor = ThreadPoolExecutor(max_workers=DNS_CHALLENGE_MAX_WORKERS)
+    return _dns_challenge_executor
+
+
+def _map_with_app_context(func, items):
+    """
+    Calls func for every item on the shared thread pool and returns the results in the order of items.
+
+    The DNS challenge steps are mostly spent waiting on DNS resolvers and DNS provider APIs, so running them
+    concurrently cuts the wall-clock time of multi-SAN orders. Each worker runs inside the current Flask app context,
+    so config, logging and metrics keep working. The first exception raised by func is re-raised to the caller.
+    func must not call _map_with_app_context itself: the pool is bounded, nested calls could wait on each other.
+    """
+    items = list(items)
+    if not items:
+        return []
+    if len(items) == 1:
+        return [func(items[0])]
+
+    return list(_get_dns_challenge_executor().map(run_in_app_context(func), items))
+
+
+def _is_retryable(exception):
+    """
+    Determines if setting up the ACME client should be retried. A misconfigured authority will not fix itself.
+    :param exception:
+    :return:
+    """
+    return not isinstance(exception, InvalidAuthority)
+
+
+def _is_account_error(exception):
+    """
+    Determines if the ACME server rejected the account of a client, e.g. because the account was deactivated or its
+    key was rolled over. A cached client for that account will keep failing, so it has to be dropped.
+    :param exception:
+    :return:
+    """
+    return isinstance(exception, AcmeError) and exception.code in ("unauthorized", "accountDoesNotExist")
+
+
 class AuthorizationRecord(object):
     def __init__(self, domain, target_domain, authz, dns_challenge, change_id, cname_delegation):
         self.domain = domain
@@ -50,25 +156,12 @@ class AcmeHandler(object):
     def reuse_account(self, authority):
         if not authority.options:
             raise InvalidAuthority("Invalid authority. Options not set")
-        existing_key = False
-        existing_regr = False
-
-        for option in json.loads(authority.options):
-            if option["name"] == "acme_private_key" and option["value"]:
-                existing_key = True
-            if option["name"] == "acme_regr" and option["value"]:
-                existing_regr = True
+        options = _load_options(authority.options)
 
-        if not existing_key and current_app.config.get("ACME_PRIVATE_KEY"):
-            existing_key = True
+        existing_key = options.get("acme_private_key") or current_app.config.get("ACME_PRIVATE_KEY")
+        existing_regr = options.get("acme_regr") or current_app.config.get("ACME_REGR")
 
-        if not existing_regr and current_app.config.get("ACME_REGR"):
-            existing_regr = True
-
-        if existing_key and existing_regr:
-            return True
-        else:
-            return False
+        return bool(existing_key and existing_regr)
 
     def strip_wildcard(self, host):
         """Removes the leading *. and returns Host and whether it was removed or not (True/False)"""
@@ -85,11 +178,15 @@ class AcmeHandler(object):
         return host
 
     def request_certificate(self, acme_client, authorizations, order):
+        # The polls stay serial: the nonce pool of the ACME client's ClientNetwork is not thread-safe
         for authorization in authorizations:
             for authz in authorization.authz:
-                authorization_resource, _ = acme_client.poll(authz)
+                acme_client.poll(authz)
 
-        deadline = datetime.datetime.now() + datetime.timedelta(seconds=360)
+        # poll_and_finalize compares the deadline against datetime.now(), so it has to stay a datetime
+        deadline = datetime.datetime.now() + datetime.timedelta(
+            seconds=current_app.config.get("ACME_ORDER_POLL_TIMEOUT_SECONDS", 360)
+        )
 
         try:
             orderr = acme_client.poll_and_finalize(order, deadline)
@@ -120,30 +217,45 @@ class AcmeHandler(object):
         return pem_certificate, pem_certificate_chain
 
     def extract_cert_and_chain(self, fullchain_pem):
-        pem_certificate = OpenSSL.crypto.dump_certificate(
-            OpenSSL.crypto.FILETYPE_PEM,
-            OpenSSL.crypto.load_certificate(
-                OpenSSL.crypto.FILETYPE_PEM, fullchain_pem
-            ),
-        ).decode()
+        """
+        Splits the PEM full chain returned by the ACME server into the leaf certificate and its chain.
+
+        The ACME server returns canonical PEM, so the leaf is cut at the first END CERTIFICATE marker. Set
+        ACME_VALIDATE_FULLCHAIN_PEM to have the leaf parsed and re-serialized by OpenSSL instead.
+        """
+        # Leading whitespace would otherwise end up in the leaf, the OpenSSL round-trip used to drop it
+        fullchain_pem = fullchain_pem.lstrip()
+        if current_app.config.get("ACME_VALIDATE_FULLCHAIN_PEM", False):
+            pem_certificate = OpenSSL.crypto.dump_certificate(
+                OpenSSL.crypto.FILETYPE_PEM,
+                OpenSSL.crypto.load_certificate(
+                    OpenSSL.crypto.FILETYPE_PEM, fullchain_pem
+                ),
+            ).decode()
+        else:
+            end = fullchain_pem.index(PEM_CERTIFICATE_END) + len(PEM_CERTIFICATE_END)
+            pem_certificate = fullchain_pem[:end] + "\n"
 
         if current_app.config.get("IDENTRUST_CROSS_SIGNED_LE_ICA", False) \
-                and datetime.datetime.now() < datetime.datetime.strptime(
-                current_app.config.get("IDENTRUST_CROSS_SIGNED_LE_ICA_EXPIRATION_DATE", "17/03/21"), '%d/%m/%y'):
+                and datetime.datetime.now() < _parse_identrust_expiration_date(
+                current_app.config.get("IDENTRUST_CROSS_SIGNED_LE_ICA_EXPIRATION_DATE", "17/03/21")):
             pem_certificate_chain = current_app.config.get("IDENTRUST_CROSS_SIGNED_LE_ICA")
         else:
             pem_certificate_chain = fullchain_pem[len(pem_certificate):].lstrip()
 
         return pem_certificate, pem_certificate_chain
 
-    @retry(stop_max_attempt_number=5, wait_fixed=5000)
+    @retry(
+        retry_on_exception=_is_retryable,
+        stop_max_attempt_number=5,
+        wait_exponential_multiplier=500,
+        wait_exponential_max=10000,
+        wait_jitter_max=500,
+    )
     def setup_acme_client(self, authority):
         if not authority.options:
             raise InvalidAuthority("Invalid authority. Options not set")
-        options = {}
-
-        for option in json.loads(authority.options):
-            options[option["name"]] = option.get("value")
+        options = _load_options(authority.options)
         email = options.get("email", current_app.config.get("ACME_EMAIL"))
         tel = options.get("telephone", current_app.config.get("ACME_TEL"))
         directory_url = options.get(
@@ -157,7 +269,14 @@ class AcmeHandler(object):
 
         if existing_key and existing_regr:
             current_app.logger.debug("Reusing existing ACME account")
-            # Reuse the same account for each certificate issuance
+            # Reuse the same account, and its client and connection pool, for each certificate issuance. The nonce pool
+            # of a ClientNetwork is not thread-safe, so every thread gets its own client.
+            cache_key = (threading.get_ident(), authority.id, directory_url, existing_key, existing_regr)
+            with _acme_client_cache_lock:
+                cached = _acme_client_cache.get(cache_key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0], {}
+
             key = jose.JWK.json_loads(existing_key)
             regr = messages.RegistrationResource.json_loads(existing_regr)
             current_app.logger.debug(
@@ -165,6 +284,11 @@ class AcmeHandler(object):
             )
             net = ClientNetwork(key, account=regr)
             client = BackwardsCompatibleClientV2(net, key, directory_url)
+
+            with _acme_client_cache_lock:
+                if len(_acme_client_cache) >= ACME_CLIENT_CACHE_MAX_SIZE:
+                    _acme_client_cache.clear()
+                _acme_client_cache[cache_key] = (client, time.monotonic() + ACME_CLIENT_CACHE_TTL)
             return client, {}
         else:
             # Create an account for each certificate issuance
@@ -183,7 +307,8 @@ class AcmeHandler(object):
 
             # if store_account is checked, add the private_key and registration resources to the options
             if options['store_account']:
-                new_options = json.loads(authority.options)
+                # copy the memoized options list, it is shared with other callers of _load_json
+                new_options = list(_load_json(authority.options))
                 # the key returned by fields_to_partial_json is missing the key type, so we add it manually
                 key_dict = key.fields_to_partial_json()
                 key_dict["kty"] = "RSA"
@@ -222,6 +347,23 @@ class AcmeHandler(object):
         current_app.logger.debug("Got these domains: {0}".format(domains))
         return domains
 
+    def evict_acme_client(self, acme_client, exception):
+        """
+        Drops a cached ACME client if the ACME server rejected its account, so the next call to setup_acme_client
+        connects again instead of reusing the broken client.
+
+        :param acme_client:
+        :param exception:
+        :return: True if the client was evicted
+        """
+        if not _is_account_error(exception):
+            return False
+        with _acme_client_cache_lock:
+            stale_keys = [key for key, (client, _) in _acme_client_cache.items() if client is acme_client]
+            for key in stale_keys:
+                del _acme_client_cache[key]
+        return bool(stale_keys)
+
     def revoke_certificate(self, certificate, crl_reason=0):
         if not self.reuse_account(certificate.authority):
             raise InvalidConfiguration("There is no ACME account saved, unable to revoke the certificate.")
@@ -234,6 +376,7 @@ class AcmeHandler(object):
         try:
             acme_client.revoke(fullchain_com, crl_reason)  # revocation reason as int (per RFC 5280 section 5.3.1)
         except (errors.ConflictError, errors.ClientError, errors.Error) as e:
+            self.evict_acme_client(acme_client, e)
             # Certificate already revoked.
             current_app.logger.error("Certificate revocation failed with message: " + e.detail)
             metrics.send("acme_revoke_certificate_failure", "counter", 1)
@@ -248,16 +391,29 @@ class AcmeDnsHandler(AcmeHandler):
 
     def __init__(self):
         self.dns_providers_for_domain = {}
+        self._dns_challenge_index = None
+        self.load_dns_providers()
+
+    def load_dns_providers(self):
         try:
-            self.all_dns_providers = dns_provider_service.get_all_dns_providers()
+            self.all_dns_providers = dns_provider_service.get_all_dns_providers_cached()
         except Exception as e:
             metrics.send("AcmeHandler_init_error", "counter", 1)
             sentry.captureException()
             current_app.logger.error(f"Unable to fetch DNS Providers: {e}")
             self.all_dns_providers = []
+        # Trie of the zones of all DNS providers, to find the providers of a domain in one walk along its labels
+        self.dns_provider_zones = build_domain_trie(
+            (zone, dns_provider) for dns_provider in self.all_dns_providers for zone in dns_provider.domains or []
+        )
+
+    def refresh_dns_providers(self):
+        """Reloads the DNS providers from the database, bypassing the cache shared between handlers"""
+        dns_provider_service.invalidate_dns_providers_cache()
+        self.load_dns_providers()
 
     def get_all_zones(self, dns_provider):
-        dns_provider_options = json.loads(dns_provider.credentials)
+        dns_provider_options = _load_json(dns_provider.credentials)
         account_number = dns_provider_options.get("account_id")
         dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
         return dns_provider_plugin.get_zones(account_number=account_number)
@@ -266,29 +422,32 @@ class AcmeDnsHandler(AcmeHandler):
         """Get dns challenges for provided domain"""
 
         domain_to_validate, is_wildcard = self.strip_wildcard(host)
-        dns_challenges = []
+        dns_challenges = self._get_dns_challenge_index(authorizations).get((domain_to_validate.lower(), is_wildcard))
+        return list(dns_challenges or [])
+
+    def _get_dns_challenge_index(self, authorizations):
+        """
+        Maps (lowercased identifier, wildcard) to the DNS-01 challenges of the authorizations. The index of the last
+        seen authorizations is kept, as every domain of an order looks up its challenges in the same list.
+        """
+        cached = self._dns_challenge_index
+        if cached and cached[0] is authorizations:
+            return cached[1]
+
+        index = {}
         for authz in authorizations:
-            if not authz.body.identifier.value.lower() == domain_to_validate.lower():
-                continue
-            if is_wildcard and not authz.body.wildcard:
-                continue
-            if not is_wildcard and authz.body.wildcard:
-                continue
+            dns_challenges = index.setdefault(
+                (authz.body.identifier.value.lower(), bool(authz.body.wildcard)), []
+            )
             for combo in authz.body.challenges:
                 if isinstance(combo.chall, challenges.DNS01):
                     dns_challenges.append(combo)
 
-        return dns_challenges
+        self._dns_challenge_index = (authorizations, index)
+        return index
 
     def get_dns_provider(self, type):
-        provider_types = {
-            "cloudflare": cloudflare,
-            "dyn": dyn,
-            "route53": route53,
-            "ultradns": ultradns,
-            "powerdns": powerdns
-        }
-        provider = provider_types.get(type)
+        provider = DNS_PROVIDER_TYPES.get(type)
         if not provider:
             raise UnknownProvider("No such DNS provider: {}".format(type))
         return provider
@@ -331,7 +490,54 @@ class AcmeDnsHandler(AcmeHandler):
             domain, target_domain, order.authorizations, dns_challenges, change_ids, cname_delegation
         )
 
-    def complete_dns_challenge(self, acme_client, authz_record):
+    def wait_for_verification(self, response, dns_challenge, domain, public_key):
+        """
+        Checks that the challenge response is visible in DNS, retrying with exponential backoff: starting at
+        ACME_POLL_INTERVAL seconds, doubling up to ACME_MAX_POLL_INTERVAL, until ACME_POLL_TIMEOUT has passed.
+
+        :return: True once the response verifies, False if it still does not when the timeout is reached.
+        """
+        interval = current_app.config.get("ACME_POLL_INTERVAL", 0.5)
+        max_interval = current_app.config.get("ACME_MAX_POLL_INTERVAL", 10)
+        deadline = time.monotonic() + current_app.config.get("ACME_POLL_TIMEOUT", 500)
+        while True:
+            if response.simple_verify(dns_challenge.chall, domain, public_key):
+                return True
+            if time.monotonic() + interval > deadline:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def wait_for_dns_changes(self, authorizations):
+        """
+        Waits for the TXT records of all authorizations in one batch per DNS provider account, so their
+        propagation is awaited concurrently instead of one record after the other.
+
+        :return: True if all records were waited for, False if a DNS provider can only wait for single changes
+        """
+        batches = {}
+        for authz_record in authorizations:
+            for dns_provider in self.dns_providers_for_domain.get(authz_record.target_domain, []):
+                dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
+                if not hasattr(dns_provider_plugin, "wait_for_dns_changes"):
+                    return False
+                account_number = _load_json(dns_provider.credentials).get("account_id")
+                batches.setdefault((dns_provider_plugin, account_number), []).extend(authz_record.change_id)
+
+        for (dns_provider_plugin, account_number), change_ids in batches.items():
+            try:
+                dns_provider_plugin.wait_for_dns_changes(change_ids, account_number=account_number)
+            except Exception:
+                metrics.send("complete_dns_challenge_error", "counter", 1)
+                sentry.captureException()
+                current_app.logger.debug(
+                    f"Unable to resolve DNS challenges for change_ids: {change_ids}, account_id: {account_number}",
+                    exc_info=True,
+                )
+                raise
+        return True
+
+    def complete_dns_challenge(self, acme_client, authz_record, wait_for_dns_change=True):
         current_app.logger.debug(
             "Finalizing DNS challenge for {0}".format(
                 authz_record.authz[0].body.identifier.value
@@ -344,82 +550,110 @@ class AcmeDnsHandler(AcmeHandler):
                 "No DNS providers found for domain: {}".format(authz_record.target_domain)
             )
 
+        key = acme_client.client.net.key
+        public_key = key.public_key()
+        responses = [(dns_challenge, dns_challenge.response(key)) for dns_challenge in authz_record.dns_challenge]
         for dns_provider in dns_providers:
             # Grab account number (For Route53)
-            dns_provider_options = json.loads(dns_provider.credentials)
+            dns_provider_options = _load_json(dns_provider.credentials)
             account_number = dns_provider_options.get("account_id")
             dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
-            for change_id in authz_record.change_id:
-                try:
-                    dns_provider_plugin.wait_for_dns_change(
-                        change_id, account_number=account_number
-                    )
-                except Exception:
-                    metrics.send("complete_dns_challenge_error", "counter", 1)
-                    sentry.captureException()
-                    current_app.logger.debug(
-                        f"Unable to resolve DNS challenge for change_id: {change_id}, account_id: "
-                        f"{account_number}",
-                        exc_info=True,
-                    )
-                    raise
-
-            for dns_challenge in authz_record.dns_challenge:
-                response = dns_challenge.response(acme_client.client.net.key)
+            if wait_for_dns_change:
+                for change_id in authz_record.change_id:
+                    try:
+                        dns_provider_plugin.wait_for_dns_change(
+                            change_id, account_number=account_number
+                        )
+                    except Exception:
+                        metrics.send("complete_dns_challenge_error", "counter", 1)
+                        sentry.captureException()
+                        current_app.logger.debug(
+                            f"Unable to resolve DNS challenge for change_id: {change_id}, account_id: "
+                            f"{account_number}",
+                            exc_info=True,
+                        )
+                        raise
 
-                verified = response.simple_verify(
-                    dns_challenge.chall,
+            for dns_challenge, response in responses:
+                verified = self.wait_for_verification(
+                    response,
+                    dns_challenge,
                     authz_record.target_domain,
-                    acme_client.client.net.key.public_key(),
+                    public_key,
                 )
 
-            if not verified:
-                metrics.send("complete_dns_challenge_verification_error", "counter", 1)
-                raise ValueError("Failed verification")
+                if not verified:
+                    metrics.send("complete_dns_challenge_verification_error", "counter", 1)
+                    raise ValueError("Failed verification")
 
-            time.sleep(5)
-            res = acme_client.answer_challenge(dns_challenge, response)
-            current_app.logger.debug(f"answer_challenge response: {res}")
+                res = acme_client.answer_challenge(dns_challenge, response)
+                current_app.logger.debug(f"answer_challenge response: {res}")
 
     def get_authorizations(self, acme_client, order, order_info):
-        authorizations = []
-
+        """
+        Starts the DNS challenges for all domains of the order. The challenges are started concurrently.
+        :return: List of AuthorizationRecords, in the order of order_info.domains
+        """
+        cname_results = {}
+        if current_app.config.get("ACME_ENABLE_DELEGATED_CNAME", False):
+            # Resolve the delegation CNAMEs of all domains up front, in one concurrent batch
+            cname_domains = {}
+            for domain in order_info.domains:
+                cname_domain, _ = self.strip_wildcard(domain)
+                cname_domains[domain] = challenges.DNS01().validation_domain_name(cname_domain)
+            cnames = self.get_cnames(list(cname_domains.values()))
+            cname_results = {domain: cnames[cname_domain] for domain, cname_domain in cname_domains.items()}
+
+        # The DNS providers are read in this thread: they may be database instances of its session, which must
+        # not be used from the worker threads. Only the DNS provider calls run concurrently.
+        dns_challenges = []
         for domain in order_info.domains:
+            dns_challenges.extend(self._get_dns_challenges_for_domain(domain, cname_results.get(domain)))
 
-            # If CNAME exists, set host to the target address
-            target_domain = domain
-            if current_app.config.get("ACME_ENABLE_DELEGATED_CNAME", False):
-                cname_result, _ = self.strip_wildcard(domain)
-                cname_result = challenges.DNS01().validation_domain_name(cname_result)
-                cname_result = self.get_cname(cname_result)
-                if cname_result:
-                    target_domain = cname_result
-                    self.autodetect_dns_providers(target_domain)
-                    metrics.send(
-                        "get_authorizations_cname_delegation_for_domain", "counter", 1, metric_tags={"domain": domain}
-                    )
+        def _start(dns_challenge):
+            domain, target_domain, dns_provider_plugin, account_number, dns_provider_options = dns_challenge
+            return self.start_dns_challenge(
+                acme_client,
+                account_number,
+                domain,
+                target_domain,
+                dns_provider_plugin,
+                order,
+                dns_provider_options,
+            )
 
-            if not self.dns_providers_for_domain.get(target_domain):
-                metrics.send(
-                    "get_authorizations_no_dns_provider_for_domain", "counter", 1
-                )
-                raise Exception("No DNS providers found for domain: {}".format(target_domain))
+        return _map_with_app_context(_start, dns_challenges)
 
-            for dns_provider in self.dns_providers_for_domain[target_domain]:
-                dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
-                dns_provider_options = json.loads(dns_provider.credentials)
-                account_number = dns_provider_options.get("account_id")
-                authz_record = self.start_dns_challenge(
-                    acme_client,
-                    account_number,
-                    domain,
-                    target_domain,
-                    dns_provider_plugin,
-                    order,
-                    dns_provider.options,
-                )
-                authorizations.append(authz_record)
-        return authorizations
+    def _get_dns_challenges_for_domain(self, domain, cname_result=None):
+        """
+        Determines the DNS providers that answer the challenge of the domain.
+        :return: List of (domain, target_domain, dns_provider_plugin, account_number, dns_provider_options)
+        """
+        dns_challenges = []
+
+        # If CNAME exists, set host to the target address
+        target_domain = domain
+        if cname_result:
+            target_domain = cname_result
+            self.autodetect_dns_providers(target_domain)
+            metrics.send(
+                "get_authorizations_cname_delegation_for_domain", "counter", 1, metric_tags={"domain": domain}
+            )
+
+        if not self.dns_providers_for_domain.get(target_domain):
+            metrics.send(
+                "get_authorizations_no_dns_provider_for_domain", "counter", 1
+            )
+            raise Exception("No DNS providers found for domain: {}".format(target_domain))
+
+        for dns_provider in self.dns_providers_for_domain[target_domain]:
+            dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
+            dns_provider_options = _load_json(dns_provider.credentials)
+            account_number = dns_provider_options.get("account_id")
+            dns_challenges.append(
+                (domain, target_domain, dns_provider_plugin, account_number, dns_provider.options)
+            )
+        return dns_challenges
 
     def autodetect_dns_providers(self, domain):
         """
@@ -427,46 +661,18 @@ class AcmeDnsHandler(AcmeHandler):
         :param domain:
         :return: dns_providers: List of DNS providers that have the correct zone.
         """
-        self.dns_providers_for_domain[domain] = []
-        match_length = 0
-        for dns_provider in self.all_dns_providers:
-            if not dns_provider.domains:
-                continue
-            for name in dns_provider.domains:
-                if name == domain or domain.endswith("." + name):
-                    if len(name) > match_length:
-                        self.dns_providers_for_domain[domain] = [dns_provider]
-                        match_length = len(name)
-                    elif len(name) == match_length:
-                        self.dns_providers_for_domain[domain].append(dns_provider)
+        # The most specific zone wins
+        dns_providers = list(find_longest_domain_suffix(self.dns_provider_zones, domain))
 
+        self.dns_providers_for_domain[domain] = dns_providers
         return self.dns_providers_for_domain
 
     def finalize_authorizations(self, acme_client, authorizations):
+        # With several authorizations, wait for all their records at once where the DNS providers support it
+        waited = len(authorizations) > 1 and self.wait_for_dns_changes(authorizations)
         for authz_record in authorizations:
-            self.complete_dns_challenge(acme_client, authz_record)
-        for authz_record in authorizations:
-            dns_challenges = authz_record.dns_challenge
-            for dns_challenge in dns_challenges:
-                dns_providers = self.dns_providers_for_domain.get(authz_record.target_domain)
-                for dns_provider in dns_providers:
-                    # Grab account number (For Route53)
-                    dns_provider_plugin = self.get_dns_provider(
-                        dns_provider.provider_type
-                    )
-                    dns_provider_options = json.loads(dns_provider.credentials)
-                    account_number = dns_provider_options.get("account_id")
-                    host_to_validate, _ = self.strip_wildcard(authz_record.target_domain)
-                    host_to_validate = self.maybe_add_extension(host_to_validate, dns_provider_options)
-                    if not authz_record.cname_delegation:
-                        host_to_validate = challenges.DNS01().validation_domain_name(host_to_validate)
-                    dns_provider_plugin.delete_txt_record(
-                        authz_record.change_id,
-                        account_number,
-                        host_to_validate,
-                        dns_challenge.validation(acme_client.client.net.key),
-                    )
-
+            self.complete_dns_challenge(acme_client, authz_record, wait_for_dns_change=not waited)
+        self.delete_txt_records(acme_client, authorizations)
         return authorizations
 
     def cleanup_dns_challenges(self, acme_client, authorizations):
@@ -475,50 +681,92 @@ class AcmeDnsHandler(AcmeHandler):
         on an exception
 
         :param acme_client:
-        :param account_number:
-        :param dns_provider:
         :param authorizations:
-        :param dns_provider_options:
         :return:
         """
+        self.delete_txt_records(acme_client, authorizations, ignore_errors=True)
+
+    def delete_txt_records(self, acme_client, authorizations, ignore_errors=False):
+        """
+        Deletes the challenge TXT records of the authorizations from all DNS providers of their target domains.
+        The records are deleted concurrently.
+
+        :param acme_client:
+        :param authorizations:
+        :param ignore_errors: Record failed deletions in metrics and sentry and carry on, instead of raising
+        :return:
+        """
+        key = acme_client.client.net.key
+        txt_records = []
         for authz_record in authorizations:
-            dns_providers = self.dns_providers_for_domain.get(authz_record.target_domain)
+            validations = [dns_challenge.validation(key) for dns_challenge in authz_record.dns_challenge]
+            dns_providers = self.dns_providers_for_domain.get(authz_record.target_domain, [])
             for dns_provider in dns_providers:
                 # Grab account number (For Route53)
-                dns_provider_options = json.loads(dns_provider.credentials)
+                dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
+                dns_provider_options = _load_json(dns_provider.credentials)
                 account_number = dns_provider_options.get("account_id")
-                dns_challenges = authz_record.dns_challenge
                 host_to_validate, _ = self.strip_wildcard(authz_record.target_domain)
-                host_to_validate = self.maybe_add_extension(
-                    host_to_validate, dns_provider_options
-                )
+                host_to_validate = self.maybe_add_extension(host_to_validate, dns_provider_options)
+                if not authz_record.cname_delegation:
+                    host_to_validate = challenges.DNS01().validation_domain_name(host_to_validate)
+                for validation in validations:
+                    txt_records.append(
+                        (dns_provider_plugin, authz_record.change_id, account_number, host_to_validate, validation)
+                    )
 
-                dns_provider_plugin = self.get_dns_provider(dns_provider.provider_type)
-                for dns_challenge in dns_challenges:
-                    if not authz_record.cname_delegation:
-                        host_to_validate = dns_challenge.validation_domain_name(host_to_validate)
-                    try:
-                        dns_provider_plugin.delete_txt_record(
-                            authz_record.change_id,
-                            account_number,
-                            host_to_validate,
-                            dns_challenge.validation(acme_client.client.net.key),
-                        )
-                    except Exception as e:
-                        # If this fails, it's most likely because the record doesn't exist (It was already cleaned up)
-                        # or we're not authorized to modify it.
-                        metrics.send("cleanup_dns_challenges_error", "counter", 1)
-                        sentry.captureException()
-                        pass
+        def _delete_txt_record(txt_record):
+            dns_provider_plugin, change_id, account_number, host_to_validate, validation = txt_record
+            try:
+                dns_provider_plugin.delete_txt_record(change_id, account_number, host_to_validate, validation)
+            except Exception:
+                if not ignore_errors:
+                    raise
+                # If this fails, it's most likely because the record doesn't exist (It was already cleaned up)
+                # or we're not authorized to modify it.
+                metrics.send("cleanup_dns_challenges_error", "counter", 1)
+                sentry.captureException()
+
+        _map_with_app_context(_delete_txt_record, txt_records)
 
     def get_cname(self, domain):
         """
+        Results are cached for the TTL of the CNAME record (at most an hour), and misses (NXDOMAIN or no CNAME
+        record) for a fixed period, since delegation CNAMEs rarely change between issuances.
+
         :param domain: Domain name to look up a CNAME for.
         :return: First CNAME target or False if no CNAME record exists.
         """
+        key = domain.lower()
+        now = time.monotonic()
+        with _cname_cache_lock:
+            cached = _cname_cache.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        ttl = CNAME_NEGATIVE_CACHE_TTL
         try:
             result = dns.resolver.query(domain, 'CNAME')
+            cname = None
             if len(result) > 0:
-                return str(result[0].target).rstrip('.')
+                cname = str(result[0].target).rstrip('.')
+                ttl = min(result.rrset.ttl, CNAME_CACHE_MAX_TTL)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            cname = False
         except dns.exception.DNSException:
+            # Timeouts and unreachable nameservers may pass, they are not cached as a missing CNAME
             return False
+
+        with _cname_cache_lock:
+            if len(_cname_cache) >= CNAME_CACHE_MAX_SIZE:
+                _cname_cache.clear()
+            _cname_cache[key] = (cname, now + ttl)
+        return cname
+
+    def get_cnames(self, domains):
+        """
+        Looks up the CNAMEs for several domains concurrently.
+        :param domains: Domain names to look up a CNAME for.
+        :return: dict mapping each domain to its first CNAME target, or False if no CNAME record exists.
+        """
+        return dict(zip(domains, _map_with_app_context(self.get_cname, domains)))
@@ -78,7 +78,11 @@ class AcmeHttpChallenge(AcmeChallenge):
         authority = issuer_options.get("authority")
         acme_client, registration = self.acme.setup_acme_client(authority)
 
-        orderr = acme_client.new_order(csr)
+        try:
+            orderr = acme_client.new_order(csr)
+        except errors.Error as e:
+            self.acme.evict_acme_client(acme_client, e)
+            raise
 
         chall = []
         deployed_challenges = []
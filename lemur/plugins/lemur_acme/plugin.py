@@ -102,6 +102,9 @@ class ACMEIssuerPlugin(IssuerPlugin):
                 "The currently selected ACME CA endpoint does"
                 " not support issuing wildcard certificates."
             )
+        except AcmeError as e:
+            self.acme.evict_acme_client(acme_client, e)
+            raise
         try:
             authorizations = self.acme.get_authorizations(
                 acme_client, order, order_info
@@ -162,6 +165,9 @@ class ACMEIssuerPlugin(IssuerPlugin):
                         "The currently selected ACME CA endpoint does"
                         " not support issuing wildcard certificates."
                     )
+                except AcmeError as e:
+                    self.acme.evict_acme_client(acme_client, e)
+                    raise
 
                 authorizations = self.acme.get_authorizations(
                     acme_client, order, order_info
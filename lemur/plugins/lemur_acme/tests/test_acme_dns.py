@@ -3,7 +3,7 @@ from unittest.mock import patch, Mock
 
 import josepy as jose
 from cryptography.x509 import DNSName
-from flask import Flask
+from flask import Flask, current_app
 from lemur.plugins.lemur_acme import plugin
 from lemur.plugins.lemur_acme.acme_handlers import AuthorizationRecord
 from lemur.common.utils import generate_private_key
@@ -104,9 +104,11 @@ class TestAcmeDns(unittest.TestCase):
 
     @patch("acme.client.Client")
     @patch("lemur.plugins.lemur_acme.cloudflare.wait_for_dns_change")
+    @patch("time.sleep")
     def test_complete_dns_challenge_fail(
-            self, mock_wait_for_dns_change, mock_acme
+            self, mock_sleep, mock_wait_for_dns_change, mock_acme
     ):
+        current_app.config["ACME_POLL_TIMEOUT"] = 3
         mock_dns_provider = Mock()
         mock_dns_provider.wait_for_dns_change = Mock(return_value=True)
 
@@ -128,6 +130,8 @@ class TestAcmeDns(unittest.TestCase):
         mock_authz.change_id.append("123")
         with self.assertRaises(ValueError):
             self.acme.complete_dns_challenge(mock_acme, mock_authz)
+        # verified immediately, then after 0.5, 1 and 2 seconds; waiting another 4 seconds would pass the timeout
+        self.assertEqual(response.simple_verify.call_count, 4)
 
     @patch("acme.client.Client")
     @patch("OpenSSL.crypto", return_value="mock_cert")
@@ -341,6 +345,70 @@ class TestAcmeDns(unittest.TestCase):
         result = self.acme.finalize_authorizations(mock_acme_client, mock_authz)
         self.assertEqual(result, mock_authz)
 
+    @patch("lemur.plugins.lemur_acme.plugin.AcmeDnsHandler.delete_txt_records")
+    @patch("lemur.plugins.lemur_acme.plugin.AcmeDnsHandler.wait_for_dns_changes")
+    @patch("lemur.plugins.lemur_acme.plugin.AcmeDnsHandler.complete_dns_challenge")
+    def test_finalize_authorizations_batched_wait(
+            self, mock_complete_dns_challenge, mock_wait_for_dns_changes, mock_delete_txt_records
+    ):
+        mock_acme_client = Mock()
+        authorizations = [Mock(), Mock()]
+
+        # all records were waited for in a batch, the challenges must not wait for them again
+        mock_wait_for_dns_changes.return_value = True
+        self.acme.finalize_authorizations(mock_acme_client, authorizations)
+        mock_wait_for_dns_changes.assert_called_once_with(authorizations)
+        for authz_record in authorizations:
+            mock_complete_dns_challenge.assert_any_call(mock_acme_client, authz_record, wait_for_dns_change=False)
+
+        # a DNS provider without batch support, every challenge waits for its own records
+        mock_complete_dns_challenge.reset_mock()
+        mock_wait_for_dns_changes.return_value = False
+        self.acme.finalize_authorizations(mock_acme_client, authorizations)
+        for authz_record in authorizations:
+            mock_complete_dns_challenge.assert_any_call(mock_acme_client, authz_record, wait_for_dns_change=True)
+
+        # a single authorization has nothing to batch
+        mock_wait_for_dns_changes.reset_mock()
+        self.acme.finalize_authorizations(mock_acme_client, authorizations[:1])
+        mock_wait_for_dns_changes.assert_not_called()
+
+    @patch("lemur.plugins.lemur_acme.ultradns.wait_for_dns_changes")
+    def test_wait_for_dns_changes(self, mock_ultradns_wait_for_dns_changes):
+        def _dns_provider(account_id):
+            dns_provider = Mock()
+            dns_provider.provider_type = "ultradns"
+            dns_provider.credentials = f'{{"account_id": "{account_id}"}}'
+            return dns_provider
+
+        ultradns_provider = _dns_provider("1234")
+        self.acme.dns_providers_for_domain = {
+            "a.example.com": [ultradns_provider],
+            "b.example.com": [ultradns_provider],
+            "c.example.org": [_dns_provider("5678")],
+        }
+        authorizations = [
+            AuthorizationRecord("a.example.com", "a.example.com", [], [], [("a", "A")], False),
+            AuthorizationRecord("b.example.com", "b.example.com", [], [], [("b", "B")], False),
+            AuthorizationRecord("c.example.org", "c.example.org", [], [], [("c", "C")], False),
+        ]
+
+        self.assertTrue(self.acme.wait_for_dns_changes(authorizations))
+        # one batch per DNS provider account
+        self.assertEqual(mock_ultradns_wait_for_dns_changes.call_count, 2)
+        mock_ultradns_wait_for_dns_changes.assert_any_call([("a", "A"), ("b", "B")], account_number="1234")
+        mock_ultradns_wait_for_dns_changes.assert_any_call([("c", "C")], account_number="5678")
+
+    @patch("lemur.plugins.lemur_acme.ultradns.wait_for_dns_changes")
+    def test_wait_for_dns_changes_unsupported(self, mock_ultradns_wait_for_dns_changes):
+        # the cloudflare provider of www.test.com can only wait for single changes
+        authorizations = [
+            AuthorizationRecord("www.test.com", "www.test.com", [], [], ["1"], False),
+            AuthorizationRecord("test.fakedomain.net", "test.fakedomain.net", [], [], ["2"], False),
+        ]
+        self.assertFalse(self.acme.wait_for_dns_changes(authorizations))
+        mock_ultradns_wait_for_dns_changes.assert_not_called()
+
     @patch("lemur.plugins.lemur_acme.plugin.AcmeHandler.setup_acme_client")
     @patch("lemur.plugins.lemur_acme.plugin.authorization_service")
     @patch("lemur.plugins.lemur_acme.acme_handlers.dns_provider_service")
@@ -411,3 +479,140 @@ class TestAcmeDns(unittest.TestCase):
             result[1]["cert"],
             {"body": "pem_certificate", "chain": "chain", "external_id": "2"},
         )
+
+    @patch("lemur.plugins.lemur_acme.plugin.AcmeDnsHandler.start_dns_challenge")
+    def test_get_authorizations_multiple_domains(self, mock_start_dns_challenge):
+        mock_start_dns_challenge.side_effect = lambda client, account, domain, *args: domain
+        mock_order = Mock()
+        mock_order_info = Mock()
+        mock_order_info.account_number = 1
+        mock_order_info.domains = ["test.fakedomain.net", "www.test.com"]
+        result = self.acme.get_authorizations(
+            "acme_client", mock_order, mock_order_info
+        )
+        self.assertEqual(result, ["test.fakedomain.net", "www.test.com"])
+
+    @patch("lemur.plugins.lemur_acme.acme_handlers.dns_provider_service")
+    def test_refresh_dns_providers(self, mock_dns_provider_service):
+        dns_provider = Mock()
+        dns_provider.domains = ["example.com"]
+        mock_dns_provider_service.get_all_dns_providers_cached.return_value = [dns_provider]
+
+        self.acme.refresh_dns_providers()
+        mock_dns_provider_service.invalidate_dns_providers_cache.assert_called_once_with()
+        self.assertEqual(self.acme.all_dns_providers, [dns_provider])
+        self.assertEqual(self.acme.autodetect_dns_providers("www.example.com")["www.example.com"], [dns_provider])
+
+    @patch("lemur.plugins.lemur_acme.acme_handlers.dns.resolver.query")
+    def test_get_cname_cached(self, mock_query):
+        from lemur.plugins.lemur_acme import acme_handlers
+        acme_handlers._cname_cache.clear()
+        mock_result = MagicMock()
+        mock_result.__len__.return_value = 1
+        mock_result.__getitem__.return_value.target = "_acme-challenge.delegated.example.com."
+        mock_result.rrset.ttl = 60
+        mock_query.return_value = mock_result
+
+        result = self.acme.get_cname("_acme-challenge.Test.example.com")
+        self.assertEqual(result, "_acme-challenge.delegated.example.com")
+        result = self.acme.get_cname("_acme-challenge.test.example.com")
+        self.assertEqual(result, "_acme-challenge.delegated.example.com")
+        mock_query.assert_called_once()
+
+    @patch("lemur.plugins.lemur_acme.acme_handlers.dns.resolver.query")
+    def test_get_cname_negative_cache(self, mock_query):
+        from lemur.plugins.lemur_acme import acme_handlers
+        acme_handlers._cname_cache.clear()
+
+        mock_query.side_effect = acme_handlers.dns.exception.Timeout()
+        self.assertFalse(self.acme.get_cname("_acme-challenge.test.example.com"))
+        self.assertFalse(self.acme.get_cname("_acme-challenge.test.example.com"))
+        self.assertEqual(mock_query.call_count, 2)
+
+        mock_query.reset_mock()
+        mock_query.side_effect = acme_handlers.dns.resolver.NXDOMAIN()
+        self.assertFalse(self.acme.get_cname("_acme-challenge.test.example.com"))
+        self.assertFalse(self.acme.get_cname("_acme-challenge.test.example.com"))
+        mock_query.assert_called_once()
+
+    @patch("lemur.plugins.lemur_acme.acme_handlers.jose.JWK.json_loads")
+    @patch("lemur.plugins.lemur_acme.acme_handlers.BackwardsCompatibleClientV2")
+    def test_setup_acme_client_cached(self, mock_acme, mock_key_json_load):
+        from lemur.plugins.lemur_acme import acme_handlers
+        acme_handlers._acme_client_cache.clear()
+        mock_authority = Mock()
+        mock_authority.id = 3
+        mock_authority.options = '[{"name": "acme_url", "value": "https://acme.example.com/directory"}, ' \
+                                 '{"name": "acme_private_key", "value": "{\\"n\\": \\"PwIOkViO\\", \\"kty\\": \\"RSA\\"}"}, ' \
+                                 '{"name": "acme_regr", "value": "{\\"body\\": {}, \\"uri\\": \\"http://test.com\\"}"}]'
+        mock_key_json_load.return_value = jose.JWKRSA(key=generate_private_key("RSA2048"))
+
+        first_client, _ = self.acme.setup_acme_client(mock_authority)
+        second_client, _ = self.acme.setup_acme_client(mock_authority)
+
+        self.assertIs(first_client, second_client)
+        mock_acme.assert_called_once()
+
+    @patch("lemur.plugins.lemur_acme.acme_handlers.dns_provider_service")
+    def test_autodetect_dns_providers(self, mock_dns_provider_service):
+        provider_a = Mock()
+        provider_a.domains = ["example.com"]
+        provider_b = Mock()
+        provider_b.domains = ["test.example.com", "example.net"]
+        provider_c = Mock()
+        provider_c.domains = ["test.example.com"]
+        provider_d = Mock()
+        provider_d.domains = None
+        mock_dns_provider_service.get_all_dns_providers_cached.return_value = [
+            provider_a, provider_b, provider_c, provider_d
+        ]
+        acme = plugin.AcmeDnsHandler()
+
+        acme.autodetect_dns_providers("www.test.example.com")
+        self.assertEqual(acme.dns_providers_for_domain["www.test.example.com"], [provider_b, provider_c])
+        acme.autodetect_dns_providers("www.example.com")
+        self.assertEqual(acme.dns_providers_for_domain["www.example.com"], [provider_a])
+        acme.autodetect_dns_providers("example.net")
+        self.assertEqual(acme.dns_providers_for_domain["example.net"], [provider_b])
+        acme.autodetect_dns_providers("www.otherexample.com")
+        self.assertEqual(acme.dns_providers_for_domain["www.otherexample.com"], [])
+
+    @patch("lemur.plugins.lemur_acme.acme_handlers.sentry")
+    @patch("lemur.plugins.lemur_acme.acme_handlers.metrics")
+    @patch("lemur.plugins.lemur_acme.cloudflare.delete_txt_record")
+    def test_cleanup_dns_challenges(self, mock_delete_txt_record, mock_metrics, mock_sentry):
+        mock_delete_txt_record.side_effect = Exception("Record not found")
+        mock_dns_challenge = Mock()
+        mock_dns_challenge.validation = Mock(return_value="ABCDEFGHIJ")
+        authz_record = AuthorizationRecord(
+            "www.test.com", "www.test.com", [], [mock_dns_challenge], ["change_id"], False
+        )
+
+        self.acme.cleanup_dns_challenges(Mock(), [authz_record])
+
+        mock_delete_txt_record.assert_called_once_with(
+            ["change_id"], None, "_acme-challenge.www.test.com", "ABCDEFGHIJ"
+        )
+        mock_metrics.send.assert_called_once_with("cleanup_dns_challenges_error", "counter", 1)
+
+    def test_get_dns_challenges_wildcard(self):
+        from acme import challenges
+
+        def _authz(value, wildcard):
+            authz = Mock()
+            authz.body.identifier.value = value
+            authz.body.wildcard = wildcard
+            dns_challenge = Mock()
+            dns_challenge.chall = challenges.DNS01()
+            http_challenge = Mock()
+            http_challenge.chall = challenges.HTTP01()
+            authz.body.challenges = [dns_challenge, http_challenge]
+            return authz, dns_challenge
+
+        authz, dns_challenge = _authz("example.com", None)
+        wildcard_authz, wildcard_dns_challenge = _authz("example.com", True)
+        authorizations = [authz, wildcard_authz]
+
+        self.assertEqual(self.acme.get_dns_challenges("Example.com", authorizations), [dns_challenge])
+        self.assertEqual(self.acme.get_dns_challenges("*.example.com", authorizations), [wildcard_dns_challenge])
+        self.assertEqual(self.acme.get_dns_challenges("www.example.com", authorizations), [])
@@ -82,6 +82,33 @@ class TestAcmeHandler(unittest.TestCase):
         assert result_client
         assert result_registration
 
+    @patch("lemur.plugins.lemur_acme.acme_handlers.messages")
+    @patch("lemur.plugins.lemur_acme.acme_handlers.jose")
+    @patch("lemur.plugins.lemur_acme.acme_handlers.ClientNetwork")
+    @patch("lemur.plugins.lemur_acme.acme_handlers.BackwardsCompatibleClientV2")
+    def test_setup_acme_client_reuse_cached(self, mock_acme, mock_net, mock_jose, mock_messages):
+        acme_handlers._acme_client_cache.clear()
+        self.addCleanup(acme_handlers._acme_client_cache.clear)
+        mock_authority = Mock()
+        mock_authority.id = 1
+        mock_authority.options = '[{"name": "acme_private_key", "value": "PRIVATE_KEY"}, ' \
+                                 '{"name": "acme_regr", "value": "ACME_REGR"}]'
+        mock_acme.side_effect = [Mock(), Mock()]
+
+        first_client, _ = self.acme.setup_acme_client(mock_authority)
+        second_client, _ = self.acme.setup_acme_client(mock_authority)
+        self.assertIs(first_client, second_client)
+        self.assertEqual(mock_acme.call_count, 1)
+
+        # a client is only dropped if the ACME server rejected its account
+        self.assertFalse(self.acme.evict_acme_client(first_client, Exception("boom")))
+        unauthorized = acme_handlers.AcmeError(typ="urn:ietf:params:acme:error:unauthorized")
+        self.assertTrue(self.acme.evict_acme_client(first_client, unauthorized))
+
+        third_client, _ = self.acme.setup_acme_client(mock_authority)
+        self.assertIsNot(first_client, third_client)
+        self.assertEqual(mock_acme.call_count, 2)
+
     def test_get_domains_single(self):
         options = {"common_name": "test.netflix.net"}
         result = self.acme.get_domains(options)
@@ -110,3 +137,15 @@ class TestAcmeHandler(unittest.TestCase):
         self.assertEqual(
             result, [options["common_name"], "test2.netflix.net"]
         )
+
+    def test_extract_cert_and_chain(self):
+        from lemur.tests.vectors import SAN_CERT_STR, INTERMEDIATE_CERT_STR, ROOTCA_CERT_STR
+
+        fullchain_pem = SAN_CERT_STR + INTERMEDIATE_CERT_STR + "\n" + ROOTCA_CERT_STR
+        pem_certificate, pem_certificate_chain = self.acme.extract_cert_and_chain(fullchain_pem)
+        self.assertEqual(pem_certificate, SAN_CERT_STR)
+        self.assertEqual(pem_certificate_chain, INTERMEDIATE_CERT_STR + "\n" + ROOTCA_CERT_STR)
+
+        pem_certificate, pem_certificate_chain = self.acme.extract_cert_and_chain("\n" + fullchain_pem)
+        self.assertEqual(pem_certificate, SAN_CERT_STR)
+        self.assertEqual(pem_certificate_chain, INTERMEDIATE_CERT_STR + "\n" + ROOTCA_CERT_STR)
@@ -27,20 +27,71 @@ class TestUltradns(unittest.TestCase):
         assert self.ctx
         self.ctx.push()
 
+        # Several tests replace functions of the ultradns module with mocks, restore them after each test
+        self.ultradns_attributes = dict(vars(ultradns))
+        ultradns._zones_cache.clear()
+        ultradns._get_zone_name.cache_clear()
+
     def tearDown(self):
+        vars(ultradns).update(self.ultradns_attributes)
         self.ctx.pop()
 
-    @patch("lemur.plugins.lemur_acme.ultradns.requests")
+    @patch("lemur.plugins.lemur_acme.ultradns._get_session")
     @patch("lemur.plugins.lemur_acme.ultradns.current_app")
-    def test_ultradns_get_token(self, mock_current_app, mock_requests):
+    def test_ultradns_get_token(self, mock_current_app, mock_get_session):
         # ret_val = json.dumps({"access_token": "access"})
+        ultradns._token_cache.clear()
         the_response = Response()
         the_response._content = b'{"access_token": "access"}'
-        mock_requests.post = Mock(return_value=the_response)
+        mock_get_session.return_value.post = Mock(return_value=the_response)
         mock_current_app.config.get = Mock(return_value="Test")
         result = ultradns.get_ultradns_token()
         self.assertTrue(len(result) > 0)
 
+    @patch("lemur.plugins.lemur_acme.ultradns._get_session")
+    @patch("lemur.plugins.lemur_acme.ultradns.current_app")
+    def test_ultradns_get_token_cached(self, mock_current_app, mock_get_session):
+        ultradns._token_cache.clear()
+        the_response = Response()
+        the_response._content = b'{"access_token": "access", "expires_in": "3600"}'
+        mock_get_session.return_value.post = Mock(return_value=the_response)
+        mock_current_app.config.get = Mock(return_value="Test")
+        self.assertEqual(ultradns.get_ultradns_token(), "access")
+        self.assertEqual(ultradns.get_ultradns_token(), "access")
+        mock_get_session.return_value.post.assert_called_once()
+
+    @patch("lemur.plugins.lemur_acme.ultradns.time.sleep")
+    @patch("lemur.plugins.lemur_acme.ultradns._generate_header")
+    @patch("lemur.plugins.lemur_acme.ultradns._get_session")
+    def test_ultradns_request_rate_limited(self, mock_get_session, mock_generate_header, mock_sleep):
+        rate_limited = Response()
+        rate_limited.status_code = 429
+        rate_limited.headers["Retry-After"] = "2"
+        ok = Response()
+        ok.status_code = 200
+        ok._content = b'{"zones": []}'
+        mock_get_session.return_value.request = Mock(side_effect=[rate_limited, ok])
+        self.assertEqual(ultradns._get("/v2/zones"), {"zones": []})
+        mock_sleep.assert_called_once_with(2.0)
+
+    @patch("lemur.plugins.lemur_acme.ultradns.time.sleep")
+    @patch("lemur.plugins.lemur_acme.ultradns._generate_header")
+    def test_ultradns_request_rate_limit_retries(self, mock_generate_header, mock_sleep):
+        # The session adapter must not retry 429 itself, or its retries multiply with the ones in _request
+        adapter = ultradns._get_session().get_adapter("https://api.ultradns.com")
+        self.assertNotIn(429, adapter.max_retries.status_forcelist)
+
+        rate_limited = Response()
+        rate_limited.status_code = 429
+        with patch.object(ultradns._get_session(), "request", Mock(return_value=rate_limited)) as mock_request:
+            with self.assertRaises(ultradns.requests.exceptions.HTTPError):
+                ultradns._get("/v2/zones")
+        self.assertEqual(mock_request.call_count, ultradns.RATE_LIMIT_RETRIES + 1)
+        self.assertEqual(mock_sleep.call_count, ultradns.RATE_LIMIT_RETRIES)
+
+    def test_ultradns_session_reused(self):
+        self.assertIs(ultradns._get_session(), ultradns._get_session())
+
     @patch("lemur.plugins.lemur_acme.ultradns.current_app")
     def test_ultradns_create_txt_record(self, mock_current_app):
         domain = "_acme_challenge.test.example.com"
@@ -61,6 +112,27 @@ class TestUltradns(unittest.TestCase):
         mock_current_app.logger.debug.assert_called_with(log_data)
         self.assertEqual(result, change_id)
 
+    @patch("lemur.plugins.lemur_acme.ultradns._delete")
+    @patch("lemur.plugins.lemur_acme.ultradns.get_zone_name")
+    def test_ultradns_delete_acme_txt_records(self, mock_get_zone_name, mock_delete):
+        mock_get_zone_name.return_value = "example.com"
+        ultradns.delete_acme_txt_records("_acme-challenge.test.example.com")
+        mock_delete.assert_called_once_with("/v2/zones/example.com/rrsets/16/_acme-challenge.test")
+
+        mock_delete.reset_mock()
+        ultradns.delete_acme_txt_records("_acme-challengetest.example.com")
+        mock_delete.assert_not_called()
+
+    def test_ultradns_get_node_name(self):
+        for domain, zone_name in [
+            ("_acme-challenge.test.example.com", "test.example.com"),
+            ("_acme-challenge.test.example.com", "example.com"),
+            ("_acme-challenge.a.b.c.example.com", "c.example.com"),
+            ("example.com", "example.com"),
+        ]:
+            zone_parts = len(zone_name.split("."))
+            self.assertEqual(ultradns._get_node_name(domain, zone_name), ".".join(domain.split(".")[:-zone_parts]))
+
     @patch("lemur.plugins.lemur_acme.ultradns.current_app")
     @patch("lemur.extensions.metrics")
     def test_ultradns_delete_txt_record(self, mock_metrics, mock_current_app):
@@ -87,7 +159,7 @@ class TestUltradns(unittest.TestCase):
     @patch("lemur.plugins.lemur_acme.ultradns.current_app")
     @patch("lemur.extensions.metrics")
     def test_ultradns_wait_for_dns_change(self, mock_metrics, mock_current_app):
-        ultradns._has_dns_propagated = Mock(return_value=True)
+        ultradns._check_dns_propagated = Mock(return_value=True)
         nameserver = "1.1.1.1"
         ultradns.get_authoritative_nameserver = Mock(return_value=nameserver)
         mock_metrics.send = Mock()
@@ -105,14 +177,76 @@ class TestUltradns(unittest.TestCase):
         }
         mock_current_app.logger.debug.assert_called_with(log_data)
 
-    def test_ultradns_get_zone_name(self):
+    def test_ultradns_resolver_reused(self):
+        resolver = ultradns._get_resolver("1.1.1.1")
+        self.assertEqual(resolver.nameservers, ["1.1.1.1"])
+        self.assertIs(ultradns._get_resolver("1.1.1.1"), resolver)
+        self.assertIsNot(ultradns._get_resolver("8.8.8.8"), resolver)
+
+    @patch("lemur.plugins.lemur_acme.ultradns.get_authoritative_nameserver")
+    @patch("lemur.plugins.lemur_acme.ultradns._check_dns_propagated")
+    @patch("lemur.plugins.lemur_acme.ultradns.metrics")
+    def test_ultradns_wait_for_dns_changes(self, mock_metrics, mock_check_dns_propagated, mock_nameserver):
+        mock_nameserver.return_value = "1.1.1.1"
+        mock_check_dns_propagated.return_value = True
+        change_ids = [("_acme-challenge.a.example.com", "A"), ("_acme-challenge.b.example.com", "B")]
+        ultradns.wait_for_dns_changes(change_ids)
+        self.assertEqual(mock_check_dns_propagated.call_count, 4)
+        mock_check_dns_propagated.assert_any_call(
+            "_acme-challenge.b.example.com", "B", "8.8.8.8", ultradns.Counter()
+        )
+        mock_metrics.send.assert_called_once_with("wait_for_dns_change.success", "counter", 2)
+
+    @patch("lemur.plugins.lemur_acme.ultradns.time.sleep")
+    @patch("lemur.plugins.lemur_acme.ultradns._check_dns_propagated")
+    def test_ultradns_poll_backoff(self, mock_check_dns_propagated, mock_sleep):
+        propagated = {"1.1.1.1": [False, True], "8.8.8.8": [False, False, False, True]}
+        mock_check_dns_propagated.side_effect = lambda fqdn, token, nameserver, metric_counts: \
+            propagated[nameserver].pop(0)
+        deadline = ultradns.time.monotonic() + 60
+        checks = {
+            ("_acme-challenge.test.example.com", "ABCDEFGHIJ", "1.1.1.1"): "authoritative",
+            ("_acme-challenge.test.example.com", "ABCDEFGHIJ", "8.8.8.8"): "public",
+        }
+        result = ultradns._poll(checks, deadline, ultradns.Counter())
+        self.assertEqual(result, {})
+        self.assertEqual(mock_check_dns_propagated.call_count, 6)
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [2.0, 3.0, 4.5])
+
+    @patch("lemur.plugins.lemur_acme.ultradns._get")
+    def test_ultradns_get_zone_name(self, mock_get):
         zones = ['example.com', 'test.example.com']
         zone = "test.example.com"
         domain = "_acme-challenge.test.example.com"
         account_number = "1234567890"
-        ultradns.get_zones = Mock(return_value=zones)
+
+        def _get(path, params):
+            name = params["q"][len("name:"):]
+            matches = [{"properties": {"name": name, "type": "PRIMARY", "status": "ACTIVE"}}
+                       for z in zones if f"{z}." == name]
+            return {"zones": matches, "resultInfo": {"totalCount": len(matches)}}
+
+        mock_get.side_effect = _get
         result = ultradns.get_zone_name(domain, account_number)
         self.assertEqual(result, zone)
+        self.assertEqual(ultradns.get_zone_name(domain, account_number), zone)
+        mock_get.assert_called_once_with("/v2/zones", {"q": "name:test.example.com.", "offset": 0, "limit": 1000})
+
+    @patch("lemur.plugins.lemur_acme.ultradns._get")
+    def test_ultradns_zone_exists_paginated(self, mock_get):
+        # the name filter matches 1500 zones, the exact match is only on the second page
+        def _get(path, params):
+            name = params["q"][len("name:"):]
+            names = [f"sub{i}.{name}" for i in range(1500)]
+            if name == "example.com.":
+                names[1200] = name
+            page = names[params["offset"]:params["offset"] + params["limit"]]
+            return {"zones": [{"properties": {"name": name, "type": "PRIMARY", "status": "ACTIVE"}} for name in page],
+                    "resultInfo": {"totalCount": len(names)}}
+
+        mock_get.side_effect = _get
+        self.assertTrue(ultradns._zone_exists("example.com"))
+        self.assertFalse(ultradns._zone_exists("example.org"))
 
     def test_ultradns_get_zones(self):
         account_number = "1234567890"
@@ -144,6 +278,38 @@ class TestUltradns(unittest.TestCase):
                                             'example.ultradns.biz.', 'example.ultradns.org.']}},
             'inherit': 'ALL'}]
         ultradns._paginate = Mock(path, "zones")
-        ultradns._paginate.side_effect = [[paginate_response]]
+        ultradns._paginate.side_effect = [paginate_response]
         result = ultradns.get_zones(account_number)
         self.assertEqual(result, zones)
+
+    @patch("lemur.plugins.lemur_acme.ultradns._paginate")
+    def test_ultradns_get_zones_cached(self, mock_paginate):
+        account_number = "1234567890"
+        mock_paginate.return_value = [{
+            'properties': {'name': 'example.com.', 'type': 'PRIMARY', 'status': 'ACTIVE'}}]
+        self.assertEqual(ultradns.get_zones(account_number), ["example.com"])
+        self.assertEqual(ultradns.get_zones(account_number), ["example.com"])
+        mock_paginate.assert_called_once()
+
+    @patch("lemur.plugins.lemur_acme.ultradns._get")
+    @patch("lemur.plugins.lemur_acme.ultradns._paginate")
+    def test_ultradns_get_zone_name_from_cached_zones(self, mock_paginate, mock_get):
+        account_number = "1234567890"
+        mock_paginate.return_value = [
+            {'properties': {'name': name, 'type': 'PRIMARY', 'status': 'ACTIVE'}}
+            for name in ['example.com.', 'test.example.com.', 'other.com.']
+        ]
+        ultradns.get_zones(account_number)
+        result = ultradns.get_zone_name("_acme-challenge.a.test.example.com", account_number)
+        self.assertEqual(result, "test.example.com")
+        mock_get.assert_not_called()
+
+    @patch("lemur.plugins.lemur_acme.ultradns._get")
+    def test_ultradns_paginate(self, mock_get):
+        def _get(path, params):
+            return {"zones": [params["offset"]], "resultInfo": {"totalCount": 2500}}
+
+        mock_get.side_effect = _get
+        result = list(ultradns._paginate("/v2/zones", "zones"))
+        self.assertEqual(result, [0, 1000, 2000])
+        self.assertEqual(mock_get.call_count, 3)
@@ -1,7 +1,9 @@
 import time
 import requests
-import json
 import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import dns
 import dns.exception
@@ -10,7 +12,9 @@ import dns.query
 import dns.resolver
 
 from flask import current_app
+from lemur.common.utils import build_domain_trie, find_longest_domain_suffix, run_in_app_context
 from lemur.extensions import metrics, sentry
+from urllib3.util.retry import Retry
 
 
 class Record:
@@ -77,185 +81,402 @@ class Zone:
         return self._data["properties"]["status"]
 
 
+TOKEN_EXPIRY_MARGIN = 60
+PAGINATE_MAX_WORKERS = 8
+ZONES_CACHE_TTL = 300
+POLL_INITIAL_DELAY = 2.0
+POLL_MAX_DELAY = 15.0
+POLL_TIMEOUT = 400
+DNS_CHECK_MAX_WORKERS = 16
+DNS_CHECK_LIFETIME = 5.0
+RATE_LIMIT_RETRIES = 3
+
+_ACME_PREFIX = "_acme-challenge."
+
+_session = None
+_dns_check_executor = None
+
+# nameserver -> dns.resolver.Resolver querying only that nameserver
+_resolvers = {}
+
+# (username, base_uri) -> (access_token, monotonic time after which it is refreshed, request headers)
+_token_cache = {}
+
+# account_number -> (zone names, zone trie, monotonic time after which they are fetched again)
+_zones_cache = {}
+
+def _get_session():
+    """
+    Returns the requests.Session shared by all calls to the UltraDNS API, so connections to it are kept alive
+    and reused instead of doing a TLS handshake per call.
+    """
+    global _session
+    if _session is None:
+        session = requests.Session()
+        # 429 is left to _request, which retries it for all methods, after the delay UltraDNS asks for
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+
+def _get_dns_check_executor():
+    """
+    Returns the thread pool shared by all propagation checks, so that concurrent DNS challenges are checked
+    by a bounded number of threads instead of a new pool per challenge.
+    """
+    global _dns_check_executor
+    if _dns_check_executor is None:
+        _dns_check_executor = ThreadPoolExecutor(max_workers=DNS_CHECK_MAX_WORKERS)
+    return _dns_check_executor
+
+
+def _get_resolver(nameserver):
+    """
+    Returns the resolver for the nameserver. Resolvers are built once per nameserver, without reading
+    /etc/resolv.conf, and reused by all propagation checks.
+    """
+    resolver = _resolvers.get(nameserver)
+    if resolver is None:
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [nameserver]
+        resolver.lifetime = DNS_CHECK_LIFETIME
+        _resolvers[nameserver] = resolver
+    return resolver
+
+
 def get_ultradns_token():
     """
     Function to call the UltraDNS Authorization API.
 
     Returns the Authorization access_token which is valid for 1 hour.
-    Each request calls this function and we generate a new token every time.
+    The token is cached and reused until shortly before it expires.
     """
+    return _get_token_entry()[0]
+
+
+def _get_token_entry():
+    """Returns the _token_cache entry of the configured account, authorizing again if it is missing or expired"""
+    username = current_app.config.get("ACME_ULTRADNS_USERNAME", "")
+    base_uri = current_app.config.get("ACME_ULTRADNS_DOMAIN", "")
+    cached = _token_cache.get((username, base_uri))
+    if cached and cached[1] > time.monotonic():
+        return cached
+
     path = "/v2/authorization/token"
     data = {
         "grant_type": "password",
-        "username": current_app.config.get("ACME_ULTRADNS_USERNAME", ""),
+        "username": username,
         "password": current_app.config.get("ACME_ULTRADNS_PASSWORD", ""),
     }
+    resp = _get_session().post(f"{base_uri}{path}", data=data, verify=True)
+    token = resp.json()
+    expires_in = int(token.get("expires_in", 3600))
+    entry = (
+        token["access_token"],
+        time.monotonic() + expires_in - TOKEN_EXPIRY_MARGIN,
+        {"Authorization": f"Bearer {token['access_token']}"},
+    )
+    _token_cache[(username, base_uri)] = entry
+    return entry
+
+
+def _invalidate_ultradns_token():
+    """Drops the cached token, so the next request authorizes again"""
+    username = current_app.config.get("ACME_ULTRADNS_USERNAME", "")
     base_uri = current_app.config.get("ACME_ULTRADNS_DOMAIN", "")
-    resp = requests.post(f"{base_uri}{path}", data=data, verify=True)
-    return resp.json()["access_token"]
+    _token_cache.pop((username, base_uri), None)
 
 
 def _generate_header():
     """
     Function to generate the header for a request.
 
-    Contains the Authorization access_key obtained from the get_ultradns_token() function.
+    Contains the Authorization access_key obtained from the get_ultradns_token() function. The header dict is
+    built once per token and shared by all requests, so it must not be modified.
     """
-    access_token = get_ultradns_token()
-    return {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    return _get_token_entry()[2]
 
 
-def _paginate(path, key):
-    limit = 100
-    params = {"offset": 0, "limit": 1}
-    resp = _get(path, params)
-    for index in range(0, resp["resultInfo"]["totalCount"], limit):
-        params["offset"] = index
-        params["limit"] = limit
-        resp = _get(path, params)
-        yield resp[key]
+def _paginate(path, key, params=None):
+    """
+    Yields the entries of a paginated listing in order. The first page tells the total count, the remaining
+    pages are then fetched concurrently and only the entries under key are kept of each page. Extra params,
+    like a q filter, are sent along with every page request.
+    """
+    limit = 1000
+    params = dict(params or {}, limit=limit)
+    resp = _get(path, dict(params, offset=0))
+    total_count = resp["resultInfo"]["totalCount"]
+    yield from resp[key]
+    if total_count <= limit:
+        return
 
+    @run_in_app_context
+    def _get_page(offset):
+        return _get(path, dict(params, offset=offset))[key]
 
-def _get(path, params=None):
-    """Function to execute a GET request on the given URL (base_uri + path) with given params"""
+    with ThreadPoolExecutor(max_workers=PAGINATE_MAX_WORKERS) as executor:
+        for page in executor.map(_get_page, range(limit, total_count, limit)):
+            yield from page
+
+
+def _request(method, path, **kwargs):
+    """
+    Executes a request on the given URL (base_uri + path) and raises on HTTP errors.
+
+    If UltraDNS rejects the cached token, it is refreshed and the request is sent once more. If UltraDNS
+    rate limits the request (429), it is retried up to RATE_LIMIT_RETRIES times after waiting as long as the
+    Retry-After header asks.
+    """
     base_uri = current_app.config.get("ACME_ULTRADNS_DOMAIN", "")
-    resp = requests.get(
-        f"{base_uri}{path}",
-        headers=_generate_header(),
-        params=params,
-        verify=True,
-    )
+    session = _get_session()
+    resp = session.request(method, f"{base_uri}{path}", headers=_generate_header(), verify=True, **kwargs)
+    if resp.status_code == 401:
+        _invalidate_ultradns_token()
+        resp = session.request(method, f"{base_uri}{path}", headers=_generate_header(), verify=True, **kwargs)
+    for _ in range(RATE_LIMIT_RETRIES):
+        if resp.status_code != 429:
+            break
+        time.sleep(_get_retry_after(resp))
+        resp = session.request(method, f"{base_uri}{path}", headers=_generate_header(), verify=True, **kwargs)
     resp.raise_for_status()
-    return resp.json()
+    return resp
+
+
+def _get_retry_after(resp):
+    """Returns the seconds to wait before retrying a rate limited request, one second if UltraDNS does not say"""
+    try:
+        return max(float(resp.headers.get("Retry-After", 1)), 0)
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        return 1
+
+
+def _get(path, params=None):
+    """Function to execute a GET request on the given URL (base_uri + path) with given params"""
+    return _request("GET", path, params=params).json()
 
 
 def _delete(path):
     """Function to execute a DELETE request on the given URL"""
-    base_uri = current_app.config.get("ACME_ULTRADNS_DOMAIN", "")
-    resp = requests.delete(
-        f"{base_uri}{path}",
-        headers=_generate_header(),
-        verify=True,
-    )
-    resp.raise_for_status()
+    _request("DELETE", path)
 
 
 def _post(path, params):
     """Executes a POST request on given URL. Body is sent in JSON format"""
-    base_uri = current_app.config.get("ACME_ULTRADNS_DOMAIN", "")
-    resp = requests.post(
-        f"{base_uri}{path}",
-        headers=_generate_header(),
-        data=json.dumps(params),
-        verify=True,
-    )
-    resp.raise_for_status()
+    _request("POST", path, json=params)
 
 
 def _has_dns_propagated(name, token, domain):
     """
     Check whether the DNS change made by Lemur have propagated to the public DNS or not.
 
-    Invoked by wait_for_dns_change() function
+    Sends the metrics of the check right away, see _check_dns_propagated().
+    """
+    metric_counts = Counter()
+    status = _check_dns_propagated(name, token, domain, metric_counts)
+    for metric_name, count in metric_counts.items():
+        metrics.send(metric_name, "counter", count)
+    return status
+
+
+def _check_dns_propagated(name, token, domain, metric_counts):
+    """
+    Check whether the DNS change made by Lemur have propagated to the public DNS or not.
+
+    Invoked by wait_for_dns_change() function. The metrics of the check are counted in metric_counts (a Counter),
+    to be sent later.
     """
     txt_records = []
     try:
-        dns_resolver = dns.resolver.Resolver()
-        dns_resolver.nameservers = [domain]
-        dns_response = dns_resolver.query(name, "TXT")
+        dns_response = _get_resolver(domain).query(name, "TXT")
         for rdata in dns_response:
             for txt_record in rdata.strings:
                 txt_records.append(txt_record.decode("utf-8"))
     except dns.exception.DNSException:
-        function = sys._getframe().f_code.co_name
-        metrics.send(f"{function}.fail", "counter", 1)
+        metric_counts["_has_dns_propagated.fail"] += 1
         return False
 
     for txt_record in txt_records:
         if txt_record == token:
-            function = sys._getframe().f_code.co_name
-            metrics.send(f"{function}.success", "counter", 1)
+            metric_counts["_has_dns_propagated.success"] += 1
             return True
 
     return False
 
 
-def wait_for_dns_change(change_id, account_number=None):
+def _poll(checks, deadline, metric_counts):
     """
-    Waits and checks if the DNS changes have propagated or not.
+    Runs the propagation checks right away, and then again with an exponentially growing delay until all of
+    them succeeded or the deadline (in time.monotonic() seconds) passed. The checks run concurrently, and a
+    check that succeeded is not run again.
 
-    First check the domains authoritative server. Once this succeeds,
-    we ask a public DNS server (Google <8.8.8.8> in our case).
+    checks maps (fqdn, token, nameserver) to the message logged with its status. The metrics of the checks
+    are counted in metric_counts. Returns the checks that did not succeed.
     """
-    fqdn, token = change_id
-    number_of_attempts = 20
-    nameserver = get_authoritative_nameserver(fqdn)
-    for attempts in range(0, number_of_attempts):
-        status = _has_dns_propagated(fqdn, token, nameserver)
-        function = sys._getframe().f_code.co_name
-        log_data = {
-            "function": function,
-            "fqdn": fqdn,
-            "status": status,
-            "message": "Record status on ultraDNS authoritative server"
-        }
-        current_app.logger.debug(log_data)
-        if status:
-            time.sleep(10)
-            break
-        time.sleep(10)
-    if status:
-        nameserver = get_public_authoritative_nameserver()
-        for attempts in range(0, number_of_attempts):
-            status = _has_dns_propagated(fqdn, token, nameserver)
+    pending = dict(checks)
+    delay = POLL_INITIAL_DELAY
+
+    @run_in_app_context
+    def _check(check):
+        # Each check counts into its own Counter, they are summed up in this thread
+        check_metric_counts = Counter()
+        return _check_dns_propagated(*check, check_metric_counts), check_metric_counts
+
+    executor = _get_dns_check_executor()
+    while True:
+        checked = list(pending)
+        for check, (status, check_metric_counts) in zip(checked, executor.map(_check, checked)):
+            metric_counts.update(check_metric_counts)
             log_data = {
-                "function": function,
-                "fqdn": fqdn,
+                "function": "wait_for_dns_change",
+                "fqdn": check[0],
                 "status": status,
-                "message": "Record status on Public DNS"
+                "message": pending[check]
             }
             current_app.logger.debug(log_data)
             if status:
-                metrics.send(f"{function}.success", "counter", 1)
-                break
-            time.sleep(10)
-    if not status:
-        metrics.send(f"{function}.fail", "counter", 1, metric_tags={"fqdn": fqdn, "txt_record": token})
-        sentry.captureException(extra={"fqdn": str(fqdn), "txt_record": str(token)})
-    return
+                del pending[check]
+        if not pending or time.monotonic() > deadline:
+            return pending
+        time.sleep(delay)
+        delay = min(delay * 1.5, POLL_MAX_DELAY)
+
+
+def wait_for_dns_change(change_id, account_number=None):
+    """
+    Waits and checks if the DNS changes have propagated or not.
+
+    Checks the domains authoritative server and a public DNS server (Google <8.8.8.8> in our case)
+    at the same time, and gives up after POLL_TIMEOUT seconds.
+    """
+    wait_for_dns_changes([change_id], account_number)
+
+
+def wait_for_dns_changes(change_ids, account_number=None):
+    """
+    Waits for a batch of DNS changes to propagate, see wait_for_dns_change(). All records are checked
+    concurrently under one POLL_TIMEOUT deadline, so waiting for N records takes about as long as for one.
+
+    The untagged counter metrics of all checks are summed up and sent once at the end.
+    """
+    function = "wait_for_dns_change"
+    public_nameserver = get_public_authoritative_nameserver()
+    checks = {}
+    for fqdn, token in change_ids:
+        checks[(fqdn, token, get_authoritative_nameserver(fqdn))] = "Record status on ultraDNS authoritative server"
+        checks[(fqdn, token, public_nameserver)] = "Record status on Public DNS"
+
+    metric_counts = Counter()
+    try:
+        failed = {(fqdn, token) for fqdn, token, _ in _poll(checks, time.monotonic() + POLL_TIMEOUT, metric_counts)}
+        for fqdn, token in change_ids:
+            if (fqdn, token) in failed:
+                metrics.send(f"{function}.fail", "counter", 1, metric_tags={"fqdn": fqdn, "txt_record": token})
+                sentry.captureException(extra={"fqdn": str(fqdn), "txt_record": str(token)})
+            else:
+                metric_counts[f"{function}.success"] += 1
+    finally:
+        for metric_name, count in metric_counts.items():
+            metrics.send(metric_name, "counter", count)
 
 
 def get_zones(account_number):
-    """Get zones from the UltraDNS"""
+    """
+    Get zones from the UltraDNS
+
+    Returns the names of the active primary zones, as strings without the trailing ".".
+    Listing the zones paginates over the whole zone catalog, so the result is cached for ZONES_CACHE_TTL seconds.
+    """
+    cached = _zones_cache.get(account_number)
+    if cached and cached[2] > time.monotonic():
+        return cached[0]
+
     path = "/v2/zones"
     zones = []
-    for page in _paginate(path, "zones"):
-        for elem in page:
-            # UltraDNS zone names end with a "." - Example - lemur.example.com.
-            # We pick out the names minus the "." at the end while returning the list
-            zone = Zone(elem)
-            if zone.authoritative_type == "PRIMARY" and zone.status == "ACTIVE":
-                zones.append(zone.name)
-
+    for elem in _paginate(path, "zones"):
+        # UltraDNS zone names end with a "." - Example - lemur.example.com.
+        # We pick out the names minus the "." at the end while returning the list.
+        # The properties are read directly, most zones are filtered out and need no Zone object.
+        properties = elem.get("properties", {})
+        if properties.get("type") == "PRIMARY" and properties.get("status") == "ACTIVE":
+            zones.append(properties["name"][:-1])
+
+    _zones_cache[account_number] = (zones, build_domain_trie((zone, zone) for zone in zones), time.monotonic() + ZONES_CACHE_TTL)
     return zones
 
 
+def _find_cached_zone_name(domain, account_number):
+    """
+    Finds the most specific zone for the domain in the cached zone list of the account, without any API call.
+    Returns None if the zones are not cached or none of them matches.
+    """
+    cached = _zones_cache.get(account_number)
+    if not cached or cached[2] <= time.monotonic():
+        return None
+
+    # Like the lookups against UltraDNS, only proper parents of the domain are considered
+    zone_names = find_longest_domain_suffix(cached[1], domain.partition(".")[2])
+    return zone_names[0] if zone_names else None
+
+
+def _zone_exists(zone_name):
+    """
+    Checks whether UltraDNS has an active primary zone with exactly the given name. The name filter also matches
+    zones that merely contain the name, so all pages have to be searched on large accounts.
+    """
+    for elem in _paginate("/v2/zones", "zones", {"q": f"name:{zone_name}."}):
+        properties = elem.get("properties", {})
+        if (
+            properties.get("name") == f"{zone_name}."
+            and properties.get("type") == "PRIMARY"
+            and properties.get("status") == "ACTIVE"
+        ):
+            return True
+    return False
+
+
 def get_zone_name(domain, account_number):
-    """Get the matching zone for the given domain"""
-    zones = get_zones(account_number)
-    zone_name = ""
-    for z in zones:
-        if domain.endswith(z):
-            # Find the most specific zone possible for the domain
-            # Ex: If fqdn is a.b.c.com, there is a zone for c.com,
-            # and a zone for b.c.com, we want to use b.c.com.
-            if z.count(".") > zone_name.count("."):
-                zone_name = z
-    if not zone_name:
-        function = sys._getframe().f_code.co_name
-        metrics.send(f"{function}.fail", "counter", 1)
-        raise Exception(f"No UltraDNS zone found for domain: {domain}")
-    return zone_name
+    """
+    Get the matching zone for the given domain
+
+    Matches are cached, the cache key changes every ZONES_CACHE_TTL seconds so zone changes are picked up.
+    """
+    return _get_zone_name(domain, account_number, int(time.monotonic() // ZONES_CACHE_TTL))
+
+
+@lru_cache(maxsize=1024)
+def _get_zone_name(domain, account_number, cache_period):
+    """
+    Finds the most specific zone for the domain. If the zones of the account are cached by get_zones(), they are
+    searched first, otherwise UltraDNS is asked for each parent of the domain in turn.
+
+    Ex: If fqdn is a.b.c.com, there is a zone for c.com,
+    and a zone for b.c.com, we want to use b.c.com.
+    """
+    zone_name = _find_cached_zone_name(domain, account_number)
+    if zone_name:
+        return zone_name
+
+    labels = domain.split(".")
+    for i in range(1, len(labels) - 1):
+        candidate = ".".join(labels[i:])
+        if _zone_exists(candidate):
+            return candidate
+
+    metrics.send("get_zone_name.fail", "counter", 1)
+    raise Exception(f"No UltraDNS zone found for domain: {domain}")
+
+
+def _get_node_name(domain, zone_name):
+    """
+    Returns the owner name of the domain within the zone: the domain minus the trailing ".<zone_name>".
+    Ex: _acme-challenge.lemur in zone example.com for _acme-challenge.lemur.example.com
+    """
+    return domain[:-(len(zone_name) + 1)]
 
 
 def create_txt_record(domain, token, account_number):
@@ -272,8 +493,7 @@ def create_txt_record(domain, token, account_number):
     """
 
     zone_name = get_zone_name(domain, account_number)
-    zone_parts = len(zone_name.split("."))
-    node_name = ".".join(domain.split(".")[:-zone_parts])
+    node_name = _get_node_name(domain, zone_name)
     fqdn = f"{node_name}.{zone_name}"
     path = f"/v2/zones/{zone_name}/rrsets/TXT/{node_name}"
     params = {
@@ -332,8 +552,7 @@ def delete_txt_record(change_id, account_number, domain, token):
         return
 
     zone_name = get_zone_name(domain, account_number)
-    zone_parts = len(zone_name.split("."))
-    node_name = ".".join(domain.split(".")[:-zone_parts])
+    node_name = _get_node_name(domain, zone_name)
     path = f"/v2/zones/{zone_name}/rrsets/16/{node_name}"
 
     try:
@@ -369,7 +588,7 @@ def delete_txt_record(change_id, account_number, domain, token):
         _post(path, params)
 
 
-def delete_acme_txt_records(domain):
+def delete_acme_txt_records(domain, account_number=None):
 
     if not domain:
         function = sys._getframe().f_code.co_name
@@ -379,21 +598,19 @@ def delete_acme_txt_records(domain):
         }
         current_app.logger.debug(log_data)
         return
-    acme_challenge_string = "_acme-challenge"
-    if not domain.startswith(acme_challenge_string):
+    if not domain.startswith(_ACME_PREFIX):
         function = sys._getframe().f_code.co_name
         log_data = {
             "function": function,
             "domain": domain,
-            "acme_challenge_string": acme_challenge_string,
+            "acme_challenge_string": _ACME_PREFIX,
             "message": "Domain does not start with the acme challenge string"
         }
         current_app.logger.debug(log_data)
         return
 
-    zone_name = get_zone_name(domain)
-    zone_parts = len(zone_name.split("."))
-    node_name = ".".join(domain.split(".")[:-zone_parts])
+    zone_name = get_zone_name(domain, account_number)
+    node_name = _get_node_name(domain, zone_name)
     path = f"/v2/zones/{zone_name}/rrsets/16/{node_name}"
 
     _delete(path)
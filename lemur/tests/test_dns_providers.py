@@ -1,4 +1,7 @@
 import unittest
+from unittest.mock import patch, Mock
+
+from lemur.dns_providers import service as dns_provider_service
 from lemur.dns_providers import util as dnsutil
 
 
@@ -21,3 +24,58 @@ class TestDNSProvider(unittest.TestCase):
         self.assertFalse(dnsutil.is_valid_domain('example..io'))
         self.assertFalse(dnsutil.is_valid_domain('exa mple.io'))
         self.assertFalse(dnsutil.is_valid_domain('-'))
+
+
+class TestDNSProviderCache(unittest.TestCase):
+    def setUp(self):
+        dns_provider_service.invalidate_dns_providers_cache()
+        self.addCleanup(dns_provider_service.invalidate_dns_providers_cache)
+
+        self.dns_provider = Mock()
+        self.dns_provider.id = 1
+        self.dns_provider.name = "ultra"
+        self.dns_provider.provider_type = "ultradns"
+        self.dns_provider.credentials = '{"account_id": "1234"}'
+        self.dns_provider.options = None
+        self.dns_provider.domains = ["example.com"]
+
+        patcher = patch("lemur.dns_providers.service.get_all_dns_providers", return_value=[self.dns_provider])
+        self.mock_get_all_dns_providers = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_all_dns_providers_cached(self):
+        result = dns_provider_service.get_all_dns_providers_cached()
+        self.assertEqual(
+            result,
+            [(1, "ultra", "ultradns", '{"account_id": "1234"}', None, ["example.com"])],
+        )
+        # plain values, not the session bound model
+        self.assertIsInstance(result[0], dns_provider_service.CachedDnsProvider)
+        self.assertEqual(result[0].credentials, '{"account_id": "1234"}')
+        self.assertEqual(result[0].domains, ["example.com"])
+
+        # served from the cache within the TTL
+        self.assertIs(dns_provider_service.get_all_dns_providers_cached(), result)
+        self.mock_get_all_dns_providers.assert_called_once_with()
+
+    @patch("lemur.dns_providers.service.time.monotonic")
+    def test_get_all_dns_providers_cached_expires(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        dns_provider_service.get_all_dns_providers_cached()
+        mock_monotonic.return_value = 1000 + dns_provider_service.DNS_PROVIDERS_CACHE_TTL + 1
+        dns_provider_service.get_all_dns_providers_cached()
+        self.assertEqual(self.mock_get_all_dns_providers.call_count, 2)
+
+    @patch("lemur.dns_providers.service.DnsProvider")
+    @patch("lemur.dns_providers.service.database")
+    def test_get_all_dns_providers_cached_reloads_after_changes(self, mock_database, mock_dns_provider_model):
+        mutations = [
+            lambda: dns_provider_service.create({"name": "ultra", "provider_type": {"name": "ultradns"}}),
+            lambda: dns_provider_service.delete(1),
+            lambda: dns_provider_service.set_domains(self.dns_provider, ["example.org"]),
+        ]
+        for call_count, mutation in enumerate(mutations, start=2):
+            dns_provider_service.get_all_dns_providers_cached()
+            mutation()
+            dns_provider_service.get_all_dns_providers_cached()
+            self.assertEqual(self.mock_get_all_dns_providers.call_count, call_count)
@@ -128,3 +128,27 @@ def test_convert_pkcs7_bytes_to_pem():
 
     assert(parse_certificate("\n".join(str(root).splitlines())) == ROOTCA_CERT)
     assert (parse_certificate("\n".join(str(leaf).splitlines())) == INTERMEDIATE_CERT)
+
+
+def test_domain_trie():
+    from lemur.common.utils import build_domain_trie, find_longest_domain_suffix
+
+    trie = build_domain_trie([("example.com", "a"), ("test.example.com", "b"), ("example.com", "c")])
+    assert find_longest_domain_suffix(trie, "example.com") == ["a", "c"]
+    assert find_longest_domain_suffix(trie, "www.example.com") == ["a", "c"]
+    assert find_longest_domain_suffix(trie, "www.test.example.com") == ["b"]
+    assert find_longest_domain_suffix(trie, "example.org") == []
+    assert find_longest_domain_suffix(trie, "com") == []
+
+
+def test_run_in_app_context(app):
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import current_app
+    from lemur.common.utils import run_in_app_context
+
+    @run_in_app_context
+    def get_app():
+        return current_app._get_current_object()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(get_app).result() is app